@@ -4,6 +4,9 @@
 SAMPLE_RATE = 16000 # samples per second
 SAMPLE_LTH = 80000 # samples
 
+# Generation
+BATCH_SIZE = 64 # notes per GANSynth forward pass
+
 # Display
 PLOT = False
 DEBUG = True
@@ -11,6 +11,7 @@ from magenta.models.gansynth.lib import flags as lib_flags, generate_util as gu,
 from librosa import cqt, midi_to_hz
 
 import os, sys
+from functools import lru_cache
 import matplotlib.pyplot as plt
 import numpy as np
 import tensorflow as tf
@@ -29,7 +30,7 @@ if len(sys.argv) < 3:
 
 ckpt_dir, output_dir = sys.argv[1], sys.argv[2]
 
-batch_size = 16
+batch_size = BATCH_SIZE
 sample_rate = SAMPLE_RATE
 
 # Make an output directory if it doesn't exist
@@ -39,7 +40,8 @@ if not tf.gfile.Exists(output_dir):
 
 # Load the model
 tf.reset_default_graph()
-flags = lib_flags.Flags({'batch_size_schedule': [batch_size]})
+# eval_batch_size is read before the batch_size_schedule saved in experiment.json
+flags = lib_flags.Flags({'eval_batch_size': batch_size})
 model = lib_model.Model.load_from_path(ckpt_dir, flags)
 
 # Helper functions
@@ -65,13 +67,20 @@ def get_envelope(t_note_length, t_attack=0.010, t_release=0.3, sr=16000):
     i_sustain = int(sr * t_note_length)
     i_release = int(sr * t_release)
     i_tot = i_sustain + i_release  # attack envelope doesn't add to sound length
-    envelope = np.ones(i_tot)
+    envelope = np.ones(i_tot, dtype=np.float32)
     # Linear attack
-    envelope[:i_attack] = np.linspace(0.0, 1.0, i_attack)
+    envelope[:i_attack] = _linear_ramp(0.0, 1.0, i_attack)
     # Linear release
-    envelope[i_sustain:i_tot] = np.linspace(1.0, 0.0, i_release)
+    envelope[i_sustain:i_tot] = _linear_ramp(1.0, 0.0, i_release)
     return envelope
 
+@lru_cache(maxsize=None)
+def _linear_ramp(start, stop, n):
+    """Build a read-only linear ramp once per (start, stop, length)."""
+    ramp = np.linspace(start, stop, n, dtype=np.float32)
+    ramp.flags.writeable = False
+    return ramp
+
 def combine_notes(audio_notes, start_times, end_times, velocities, sr=16000):
     """Combine audio from multiple notes into a single audio clip.
 
@@ -86,19 +95,24 @@ def combine_notes(audio_notes, start_times, end_times, velocities, sr=16000):
     """
     n_notes = len(audio_notes)
     clip_length = end_times.max() + 3.0
-    audio_clip = np.zeros(int(clip_length) * sr)
+    audio_clip = np.zeros(int(clip_length) * sr, dtype=np.float32)
+
+    # Per-note scalars, computed for all notes at once, as plain Python lists
+    note_lengths = (end_times - start_times).tolist()
+    clip_starts = (start_times * sr).astype(int).tolist()
+    gains = (velocities / 127.0).tolist()
+    # Scratch buffer reused by every note
+    scratch = np.empty(audio_notes.shape[1], dtype=audio_clip.dtype)
 
-    for t_start, t_end, vel, i in zip(start_times, end_times, velocities, range(n_notes)):
+    for i in range(n_notes):
+        clip_start = clip_starts[i]
         # Generate an amplitude envelope
-        t_note_length = t_end - t_start
-        envelope = get_envelope(t_note_length)
+        envelope = get_envelope(note_lengths[i])
         length = len(envelope)
-        audio_note = audio_notes[i, :length] * envelope
-        # Normalize
-        audio_note /= audio_note.max()
-        audio_note *= (vel / 127.0)
+        audio_note = np.multiply(audio_notes[i, :length], envelope, out=scratch[:length])
+        # Normalize and apply velocity with a single scale factor
+        audio_note *= gains[i] / audio_note.max()
         # Add to clip buffer
-        clip_start = int(t_start * sr)
         clip_end = clip_start + length
         audio_clip[clip_start:clip_end] += audio_note
         
@@ -107,16 +121,37 @@ def combine_notes(audio_notes, start_times, end_times, velocities, sr=16000):
     audio_clip /= 2.0
     return audio_clip
 
+def get_z_notes(start_times, z_instruments, t_instruments):
+    """Slerp latent vectors at each note start, for all notes at once.
+
+    Vectorized version of gu.get_z_notes.
+    """
+    z_instruments = np.asarray(z_instruments)
+    t_instruments = np.asarray(t_instruments)
+    idx = np.searchsorted(t_instruments, start_times, side='left') - 1
+    t_left = t_instruments[idx]
+    t_right = t_instruments[idx + 1]
+    interp = ((start_times - t_left) / (t_right - t_left))[:, np.newaxis]
+    z_left = z_instruments[idx]
+    z_right = z_instruments[idx + 1]
+    # Spherical linear interpolation, row by row as in gu.slerp
+    cos_omega = np.sum(z_left / np.linalg.norm(z_left, axis=1, keepdims=True) *
+                       z_right / np.linalg.norm(z_right, axis=1, keepdims=True), axis=1)
+    omega = np.arccos(cos_omega)[:, np.newaxis]
+    so = np.sin(omega)
+    z_notes = np.sin((1.0 - interp) * omega) / so * z_left + np.sin(interp * omega) / so * z_right
+    return z_notes.astype(z_instruments.dtype)
+
 # Plotting tools
+CQT_F_MIN = midi_to_hz(36)
+CQT_F_MAX = 2 * midi_to_hz(84)
+CQT_BINS_PER_OCTAVE = 36
+CQT_N_BINS = int(CQT_BINS_PER_OCTAVE * np.ceil(np.log2(CQT_F_MAX) - np.log2(CQT_F_MIN)))
+
 def specplot(audio_clip):
-    p_min = np.min(36)
-    p_max = np.max(84)
-    f_min = midi_to_hz(p_min)
-    f_max = 2 * midi_to_hz(p_max)
-    octaves = int(np.ceil(np.log2(f_max) - np.log2(f_min)))
-    bins_per_octave = 36
-    n_bins = int(bins_per_octave * octaves)
-    C = cqt(audio_clip, sr=SR, hop_length=2048, fmin=f_min, n_bins=n_bins, bins_per_octave=bins_per_octave)
+    # Fixed tuning, so newer librosa doesn't estimate it on every call
+    C = cqt(audio_clip, sr=sample_rate, hop_length=2048, fmin=CQT_F_MIN, n_bins=CQT_N_BINS,
+            bins_per_octave=CQT_BINS_PER_OCTAVE, tuning=0.0)
     power = 10 * np.log10(np.abs(C)**2 + 1e-6)
     plt.matshow(power[::-1, 2:-2], aspect='auto', cmap=plt.cm.magma)
     plt.yticks([])
@@ -143,7 +178,7 @@ seconds_per_instrument = 5
 z_instruments, t_instruments = gu.get_random_instruments(model, notes['end_times'][-1], secs_per_instrument=seconds_per_instrument)
 
 # Get latent vectors for each note
-z_notes = gu.get_z_notes(notes['start_times'], z_instruments, t_instruments)
+z_notes = get_z_notes(notes['start_times'], z_instruments, t_instruments)
 
 if DEBUG:
     print('Generating {} samples...'.format(len(z_notes)))
@@ -162,8 +197,8 @@ if PLOT:
 fname = os.path.join(output_dir, 'generated_clip.wav')
 gu.save_wav(audio_clip, fname)
 
-# Load Default, but slow it down 30%
-ns, notes_2 = load_midi(midi_path)
+# Reuse the loaded notes, but slow them down 30%
+notes_2 = {k: v.copy() for k, v in notes.items()}
 notes_2['start_times'] *= 1.3
 notes_2['end_times'] *= 1.3
 
@@ -196,7 +231,7 @@ z_instruments = [z_preview[i] for i in instruments]
 t_instruments = [notes_2['end_times'][-1] * t for t in times]
 
 # Get latent vectors for each note
-z_notes = gu.get_z_notes(notes_2['start_times'], z_instruments, t_instruments)
+z_notes = get_z_notes(notes_2['start_times'], z_instruments, t_instruments)
 
 if DEBUG:
     print('Generating {} samples...'.format(len(z_notes)))